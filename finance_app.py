@@ -1,9 +1,14 @@
+import queue
 import sqlite3
-from flask import Flask, request, jsonify, render_template_string
+import threading
+from flask import Flask, Response, request, jsonify, stream_with_context
 from datetime import datetime
 import json
 import math
+import time
+import zlib
 import requests
+from requests.adapters import HTTPAdapter
 from collections import Counter
 
 # =========================
@@ -11,6 +16,9 @@ from collections import Counter
 # =========================
 
 app = Flask(__name__)
+# Skip key sorting and debug-mode indentation when encoding responses
+app.json.sort_keys = False
+app.json.compact = True
 
 FINANCE_DB_PATH = "indago_financial_records.db"
 REQUEST_LOG_DB_PATH = "indago_request_log.db"
@@ -20,15 +28,105 @@ SALES_LOG_DB_PATH = "indago_sales_log.db"
 ORDER_APP_BASE = "http://localhost:5001"
 ORDER_WEEKLY_ENDPOINT = f"{ORDER_APP_BASE}/weekly-order"
 ORDER_WEEKLY_FALLBACK = f"{ORDER_APP_BASE}/orders-weekly"
+# (connect, read) seconds; an unreachable order_app fails fast instead of
+# holding the worker for the full read timeout
+ORDER_APP_TIMEOUT = (2, 5)
+
+# Pagination for the history/log endpoints (?limit=N&offset=M)
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+# Seconds a rendered history/log page is served from memory
+RESPONSE_CACHE_TTL = 5
+
+# Shared HTTP session: keeps connections to order_app alive between calls
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=0))
+
+# =========================
+# SQL STATEMENTS
+# =========================
+
+# Kept as module constants so each connection's statement cache reuses the
+# prepared statement instead of re-parsing the SQL on every request.
+
+SQL_INSERT_PURCHASE_REQUEST = """
+    INSERT INTO purchase_requests (
+        order_id, item_name, quantity_needed, unit, current_stock,
+        estimated_cost, status, decision_note, request_date, decision_date
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_INSERT_REQUEST_LOG = """
+    INSERT INTO request_purchase_log (
+        received_at, order_id, item_name, quantity_needed, unit,
+        current_stock, estimated_cost, status, decision_note, http_status, payload
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_INSERT_SALES_LOG = """
+    INSERT INTO weekly_sales_log (
+        scored_at,
+        week_start, week_end,
+        total_orders, total_units, total_revenue, avg_order_value,
+        top_product, sales_score,
+        source_endpoint, payload
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_SELECT_HISTORY = """
+    SELECT
+        id, order_id, item_name, quantity_needed, estimated_cost,
+        status, decision_note, request_date, decision_date
+    FROM purchase_requests
+    ORDER BY request_date DESC
+    LIMIT ? OFFSET ?
+"""
+
+SQL_SELECT_REQUEST_LOG = """
+    SELECT
+        id, received_at, order_id, item_name, quantity_needed, unit,
+        current_stock, estimated_cost, status, decision_note, http_status, payload
+    FROM request_purchase_log
+    ORDER BY received_at DESC
+    LIMIT ? OFFSET ?
+"""
+
+SQL_SELECT_SALES_LOGS = """
+    SELECT
+        id, scored_at, week_start, week_end,
+        total_orders, total_units, total_revenue, avg_order_value,
+        top_product, sales_score, source_endpoint, payload
+    FROM weekly_sales_log
+    ORDER BY scored_at DESC
+    LIMIT ? OFFSET ?
+"""
 
 # =========================
 # DATABASE HELPERS
 # =========================
 
 
+_local = threading.local()
+
+
 def get_db(db_path: str):
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    """Returns this thread's connection to db_path, opening it on first use."""
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    conn = conns.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        conns[db_path] = conn
     return conn
 
 
@@ -50,8 +148,10 @@ def init_finance_db():
             decision_date TEXT NOT NULL
         )
     """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pr_request_date ON purchase_requests(request_date DESC)")
     conn.commit()
-    conn.close()
+    # journal_mode is persistent per database file, so once at startup is enough
+    conn.execute("PRAGMA journal_mode=WAL")
 
 
 def init_request_log_db():
@@ -70,11 +170,12 @@ def init_request_log_db():
             status TEXT,
             decision_note TEXT,
             http_status INTEGER,
-            payload TEXT
+            payload BLOB
         )
     """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rpl_received_at ON request_purchase_log(received_at DESC)")
     conn.commit()
-    conn.close()
+    conn.execute("PRAGMA journal_mode=WAL")
 
 
 def init_sales_log_db():
@@ -96,11 +197,34 @@ def init_sales_log_db():
             sales_score REAL NOT NULL,
 
             source_endpoint TEXT,
-            payload TEXT
+            payload BLOB
         )
     """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_wsl_scored_at ON weekly_sales_log(scored_at DESC)")
     conn.commit()
-    conn.close()
+    conn.execute("PRAGMA journal_mode=WAL")
+
+
+def pack_payload(data):
+    """
+    Encodes a raw request/response payload for the log tables' payload
+    column: JSON indented for display in the UI, zlib-compressed.
+    """
+    text = json.dumps(data or {}, ensure_ascii=False, indent=2)
+    return zlib.compress(text.encode("utf-8"))
+
+
+def unpack_payload(value):
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    # Rows written before payloads were compressed are stored as plain TEXT,
+    # not necessarily indented; the UI shows payloads as-is, so indent them
+    if isinstance(value, str):
+        try:
+            return json.dumps(json.loads(value), ensure_ascii=False, indent=2)
+        except ValueError:
+            return value
+    return value
 
 # =========================
 # BUSINESS LOGIC (FINANCE)
@@ -114,18 +238,20 @@ def evaluate_purchase_request(estimated_cost):
     return "REJECTED", f"Auto-rejected: exceeds budget limit ({BUDGET_LIMIT})."
 
 
-def log_request_purchase(data, status, note, http_status):
-    now = datetime.utcnow().isoformat()
+# Audit rows waiting for the request log writer thread
+_log_queue = queue.Queue()
+LOG_BATCH_SIZE = 100
 
-    conn = get_db(REQUEST_LOG_DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO request_purchase_log (
-            received_at, order_id, item_name, quantity_needed, unit,
-            current_stock, estimated_cost, status, decision_note, http_status, payload
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+
+def log_request_purchase(data, status, note, http_status, now=None):
+    """
+    Queues an audit row for request_purchase_log. The purchase decision
+    doesn't depend on it, so the HTTP response doesn't wait for the write.
+    Pass now to reuse the timestamp the caller already took.
+    """
+    now = now or datetime.utcnow().isoformat()
+
+    _log_queue.put((
         now,
         (data or {}).get("order_id"),
         (data or {}).get("item_name"),
@@ -136,30 +262,61 @@ def log_request_purchase(data, status, note, http_status):
         status,
         note,
         http_status,
-        json.dumps(data or {}, ensure_ascii=False)
+        pack_payload(data)
     ))
-    conn.commit()
-    conn.close()
+
+
+def request_log_writer():
+    """
+    Drains _log_queue, inserting up to LOG_BATCH_SIZE rows per transaction.
+    """
+    while True:
+        rows = [_log_queue.get()]
+        try:
+            while len(rows) < LOG_BATCH_SIZE:
+                rows.append(_log_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        try:
+            conn = get_db(REQUEST_LOG_DB_PATH)
+            with conn:
+                conn.executemany(SQL_INSERT_REQUEST_LOG, rows)
+        except Exception:
+            app.logger.exception("Failed to write %d request log rows", len(rows))
+
+
+threading.Thread(target=request_log_writer, name="request-log-writer", daemon=True).start()
 
 # =========================
 # SALES SCORING LOGIC
 # =========================
 
+# Endpoint that answered the last fetch; see fetch_weekly_orders
+_weekly_endpoint = ORDER_WEEKLY_ENDPOINT
+
 
 def fetch_weekly_orders():
     """
     Tries GET /weekly-order first (as requested).
     Falls back to GET /orders-weekly for compatibility.
+    Whichever endpoint answered last is tried first next time, so a missing
+    /weekly-order route doesn't cost an extra round trip on every call.
     Returns: (source_endpoint, json_data)
     """
+    global _weekly_endpoint
+
+    first = _weekly_endpoint
+    second = ORDER_WEEKLY_FALLBACK if first == ORDER_WEEKLY_ENDPOINT else ORDER_WEEKLY_ENDPOINT
     try:
-        r = requests.get(ORDER_WEEKLY_ENDPOINT, timeout=5)
+        r = SESSION.get(first, timeout=ORDER_APP_TIMEOUT)
         r.raise_for_status()
-        return ORDER_WEEKLY_ENDPOINT, r.json()
+        return first, r.json()
     except Exception:
-        r = requests.get(ORDER_WEEKLY_FALLBACK, timeout=5)
+        r = SESSION.get(second, timeout=ORDER_APP_TIMEOUT)
         r.raise_for_status()
-        return ORDER_WEEKLY_FALLBACK, r.json()
+        _weekly_endpoint = second
+        return second, r.json()
 
 
 def normalize_orders_payload(data: dict):
@@ -169,11 +326,14 @@ def normalize_orders_payload(data: dict):
     """
     if not isinstance(data, dict):
         return []
-    for key in ("orders", "weekly_orders", "data"):
-        if isinstance(data.get(key), list):
-            return data[key]
+    # "orders" is what order_app sends, so it is checked first with one lookup
+    orders = data.get("orders")
+    if not isinstance(orders, list):
+        orders = data.get("weekly_orders")
+        if not isinstance(orders, list):
+            orders = data.get("data")
     # if the API directly returns a list (rare), caller will handle it; here we keep dict-only.
-    return []
+    return orders if isinstance(orders, list) else []
 
 
 def compute_sales_metrics(orders: list):
@@ -198,43 +358,42 @@ def compute_sales_metrics(orders: list):
     for o in orders:
         if not isinstance(o, dict):
             continue
-
-        product = o.get("product") or o.get("item") or o.get("name")
-        qty = o.get("quantity", 0)
+        get = o.get
 
         try:
-            qty = int(qty)
+            qty = int(get("quantity", 0))
         except Exception:
             qty = 0
+        if qty < 0:
+            qty = 0
 
+        product = get("product") or get("item") or get("name")
         if product:
-            product_counter[product] += max(qty, 0)
-
-        total_units += max(qty, 0)
-
-        # revenue inference
-        if o.get("total_amount") is not None:
-            try:
-                total_revenue += float(o["total_amount"])
-            except Exception:
-                pass
-        else:
-            # try price * quantity
-            if o.get("price") is not None:
-                try:
-                    total_revenue += float(o["price"]) * max(qty, 0)
-                except Exception:
-                    pass
+            product_counter[product] += qty
+
+        total_units += qty
+
+        # revenue inference: total_amount, else price * quantity
+        total_amount = get("total_amount")
+        try:
+            if total_amount is not None:
+                total_revenue += float(total_amount)
+            else:
+                price = get("price")
+                if price is not None:
+                    total_revenue += float(price) * qty
+        except Exception:
+            pass
 
         # date inference
-        if o.get("date"):
-            dates.append(o.get("date"))
+        date = get("date")
+        if date:
+            dates.append(date)
 
     if dates:
-        # strings like YYYY-MM-DD sort lexicographically correctly
-        dates_sorted = sorted(dates)
-        week_start = dates_sorted[0]
-        week_end = dates_sorted[-1]
+        # strings like YYYY-MM-DD compare lexicographically correctly
+        week_start = min(dates)
+        week_end = max(dates)
 
     avg_order_value = (
         total_revenue / total_orders) if total_orders > 0 else 0.0
@@ -260,16 +419,7 @@ def store_sales_log(source_endpoint: str, payload: dict, metrics: dict):
     conn = get_db(SALES_LOG_DB_PATH)
     c = conn.cursor()
 
-    c.execute("""
-        INSERT INTO weekly_sales_log (
-            scored_at,
-            week_start, week_end,
-            total_orders, total_units, total_revenue, avg_order_value,
-            top_product, sales_score,
-            source_endpoint, payload
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+    c.execute(SQL_INSERT_SALES_LOG, (
         datetime.utcnow().isoformat(),
         metrics.get("week_start"),
         metrics.get("week_end"),
@@ -280,13 +430,11 @@ def store_sales_log(source_endpoint: str, payload: dict, metrics: dict):
         metrics.get("top_product"),
         metrics["sales_score"],
         source_endpoint,
-        json.dumps(payload or {}, ensure_ascii=False)
+        pack_payload(payload)
     ))
 
     conn.commit()
-    log_id = c.lastrowid
-    conn.close()
-    return log_id
+    return c.lastrowid
 
 # =========================
 # UI (HTML)
@@ -440,9 +588,6 @@ UI_HTML = """
     }
 
     for (const row of data) {
-      let prettyPayload = row.payload;
-      try { prettyPayload = JSON.stringify(JSON.parse(row.payload), null, 2); } catch (e) {}
-
       const tr = document.createElement('tr');
       tr.innerHTML = `
         <td>${escapeHtml(row.id)}</td>
@@ -456,7 +601,7 @@ UI_HTML = """
         <td>${escapeHtml(row.status)}</td>
         <td>${escapeHtml(row.http_status)}</td>
         <td>${escapeHtml(row.decision_note)}</td>
-        <td><pre>${escapeHtml(prettyPayload)}</pre></td>
+        <td><pre>${escapeHtml(row.payload)}</pre></td>
       `;
       tbody.appendChild(tr);
     }
@@ -474,9 +619,6 @@ UI_HTML = """
     }
 
     for (const row of data) {
-      let prettyPayload = row.payload;
-      try { prettyPayload = JSON.stringify(JSON.parse(row.payload), null, 2); } catch (e) {}
-
       const tr = document.createElement('tr');
       tr.innerHTML = `
         <td>${escapeHtml(row.id)}</td>
@@ -490,7 +632,7 @@ UI_HTML = """
         <td>${escapeHtml(row.top_product)}</td>
         <td>${escapeHtml(row.sales_score)}</td>
         <td>${escapeHtml(row.source_endpoint)}</td>
-        <td><pre>${escapeHtml(prettyPayload)}</pre></td>
+        <td><pre>${escapeHtml(row.payload)}</pre></td>
       `;
       tbody.appendChild(tr);
     }
@@ -546,15 +688,86 @@ UI_HTML = """
 """
 
 
+# The page has no template variables, so it is encoded once and served as-is
+UI_BYTES = UI_HTML.encode("utf-8")
+
+
 @app.route("/ui", methods=["GET"])
 def ui():
-    return render_template_string(UI_HTML)
+    return Response(UI_BYTES, mimetype="text/html",
+                    headers={"Cache-Control": "public, max-age=60"})
 
 # =========================
 # API ROUTES (FINANCE)
 # =========================
 
 
+def get_page_args():
+    limit = request.args.get("limit", DEFAULT_PAGE_LIMIT, type=int)
+    offset = request.args.get("offset", 0, type=int)
+    return min(max(limit, 1), MAX_PAGE_LIMIT), max(offset, 0)
+
+
+# (table, max_id, limit, offset) -> (cached_at, body bytes)
+_response_cache = {}
+
+
+def stream_json_rows(cursor, cache_key=None):
+    """
+    Streams the cursor's rows as a JSON array, encoding one row at a time
+    instead of building the whole list in memory first.
+    With cache_key, the finished body is also stored in _response_cache.
+    """
+    def generate():
+        parts = []
+        for chunk in encode():
+            if cache_key is not None:
+                parts.append(chunk)
+            yield chunk
+        if cache_key is not None:
+            store_cached_response(cache_key, "".join(parts).encode("utf-8"))
+
+    def encode():
+        yield "["
+        first = True
+        for row in cursor:
+            item = dict(row)
+            if "payload" in item:
+                item["payload"] = unpack_payload(item["payload"])
+            yield ("" if first else ",") + json.dumps(item, separators=(",", ":"))
+            first = False
+        yield "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def store_cached_response(key, body):
+    now = time.monotonic()
+    for k, (cached_at, _) in list(_response_cache.items()):
+        if now - cached_at >= RESPONSE_CACHE_TTL:
+            _response_cache.pop(k, None)
+    _response_cache[key] = (now, body)
+
+
+def history_page(db_path, table, sql):
+    """
+    Serves one page of an append-only table. Pages are cached briefly and
+    keyed on the table's MAX(id), so any new row invalidates them.
+    """
+    limit, offset = get_page_args()
+    conn = get_db(db_path)
+    max_id = conn.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0]
+
+    key = (table, max_id, limit, offset)
+    cached = _response_cache.get(key)
+    if cached and time.monotonic() - cached[0] < RESPONSE_CACHE_TTL:
+        return Response(cached[1], mimetype="application/json")
+
+    c = conn.cursor()
+    c.execute(sql, (limit, offset))
+    return stream_json_rows(c, cache_key=key)
+
+
 @app.route("/", methods=["GET"])
 def health():
     return jsonify({"message": "Finance subsystem running"})
@@ -566,6 +779,7 @@ def process_purchase_request():
 
     required_fields = ["order_id", "item_name",
                        "quantity_needed", "estimated_cost"]
+
     if not data or not all(field in data for field in required_fields):
         log_request_purchase(
             data=data,
@@ -576,41 +790,35 @@ def process_purchase_request():
         return jsonify({"error": "Incomplete purchase request data"}), 400
 
     status, note = evaluate_purchase_request(data["estimated_cost"])
+    http_status = 201 if status == "APPROVED" else 403
     now = datetime.utcnow().isoformat()
 
     # Write to finance DB
     conn = get_db(FINANCE_DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO purchase_requests (
-            order_id, item_name, quantity_needed, unit, current_stock,
-            estimated_cost, status, decision_note, request_date, decision_date
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        data["order_id"],
-        data["item_name"],
-        data["quantity_needed"],
-        data.get("unit"),
-        data.get("current_stock"),
-        data["estimated_cost"],
-        status,
-        note,
-        now,
-        now
-    ))
-    conn.commit()
-    request_id = c.lastrowid
-    conn.close()
-
-    http_status = 201 if status == "APPROVED" else 403
-
-    # Log to request log DB
+    with conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(SQL_INSERT_PURCHASE_REQUEST, (
+            data["order_id"],
+            data["item_name"],
+            data["quantity_needed"],
+            data.get("unit"),
+            data.get("current_stock"),
+            data["estimated_cost"],
+            status,
+            note,
+            now,
+            now
+        ))
+        request_id = c.lastrowid
+
+    # Log to request log DB (written in the background)
     log_request_purchase(
         data=data,
         status=status,
         note=note,
-        http_status=http_status
+        http_status=http_status,
+        now=now
     )
 
     return jsonify({
@@ -629,34 +837,12 @@ def process_purchase_request():
 
 @app.route("/finance/history", methods=["GET"])
 def finance_history():
-    conn = get_db(FINANCE_DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        SELECT
-            id, order_id, item_name, quantity_needed, estimated_cost,
-            status, decision_note, request_date, decision_date
-        FROM purchase_requests
-        ORDER BY request_date DESC
-    """)
-    rows = c.fetchall()
-    conn.close()
-    return jsonify([dict(row) for row in rows])
+    return history_page(FINANCE_DB_PATH, "purchase_requests", SQL_SELECT_HISTORY)
 
 
 @app.route("/finance/request-log", methods=["GET"])
 def request_log():
-    conn = get_db(REQUEST_LOG_DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        SELECT
-            id, received_at, order_id, item_name, quantity_needed, unit,
-            current_stock, estimated_cost, status, decision_note, http_status, payload
-        FROM request_purchase_log
-        ORDER BY received_at DESC
-    """)
-    rows = c.fetchall()
-    conn.close()
-    return jsonify([dict(row) for row in rows])
+    return history_page(REQUEST_LOG_DB_PATH, "request_purchase_log", SQL_SELECT_REQUEST_LOG)
 
 # =========================
 # API ROUTES (SALES)
@@ -695,19 +881,7 @@ def sales_score_weekly():
 
 @app.route("/sales/logs", methods=["GET"])
 def sales_logs():
-    conn = get_db(SALES_LOG_DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        SELECT
-            id, scored_at, week_start, week_end,
-            total_orders, total_units, total_revenue, avg_order_value,
-            top_product, sales_score, source_endpoint, payload
-        FROM weekly_sales_log
-        ORDER BY scored_at DESC
-    """)
-    rows = c.fetchall()
-    conn.close()
-    return jsonify([dict(r) for r in rows])
+    return history_page(SALES_LOG_DB_PATH, "weekly_sales_log", SQL_SELECT_SALES_LOGS)
 
 # =========================
 # STARTUP
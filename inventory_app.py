@@ -1,9 +1,16 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import json
+import os
 import sqlite3
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from flask import Flask, jsonify, request, render_template_string
+from flask import Flask, Response, jsonify, request, render_template_string
 from flask_cors import CORS
 
 # =========================
@@ -11,7 +18,11 @@ from flask_cors import CORS
 # =========================
 
 app = Flask(__name__)
-CORS(app)
+# Compact, unsorted JSON for /purchase-request and error replies
+app.json.sort_keys = False
+app.json.compact = True
+# Only the stock endpoints are called cross-origin; other routes skip the hook
+CORS(app, resources={r"/stock": {"origins": "*"}, r"/consume": {"origins": "*"}})
 
 DB_PATH = "indago_inventory.db"
 
@@ -27,17 +38,41 @@ ITEM_UNITS = {
 
 LOW_STOCK_THRESHOLD = 0.1
 
+# procurement_log statuses that block another auto purchase for the item
+OPEN_PROCUREMENT_STATUSES = ("pending", "submitted")
+
 FINANCE_PURCHASE_ENDPOINT = "http://localhost:5003/PurchaseRequest"
 KITCHEN_BATCH_ENDPOINT = "http://localhost:5004/batch"
 
+# Shared HTTP session: keeps connections to the other services alive
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                     max_retries=Retry(total=2, backoff_factor=0.1)))
+
+# Background workers for auto-triggered finance calls, so /consume never
+# waits on (or holds its write transaction across) the finance round trip
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
 # =========================
 # DATABASE
 # =========================
 
 
+_local = threading.local()
+
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Per-thread inventory connection; only reused across requests under gunicorn gthread."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        # NORMAL is safe in WAL mode and skips the fsync on every commit
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-64000")
+        _local.conn = conn
     return conn
 
 
@@ -45,6 +80,9 @@ def init_db():
     conn = get_db()
     c = conn.cursor()
 
+    # Persistent per database file: readers stop blocking the writer
+    c.execute("PRAGMA journal_mode=WAL")
+
     # Inventory table
     c.execute("""
         CREATE TABLE IF NOT EXISTS inventory (
@@ -67,6 +105,11 @@ def init_db():
             created_at TEXT
         )
     """)
+    # Covers the open-procurement scan below (status filter, item names only)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_procurement_status_item
+        ON procurement_log(status, item_name)
+    """)
 
     # Seed inventory
     for item, qty in SEED_INVENTORY.items():
@@ -76,7 +119,12 @@ def init_db():
         )
 
     conn.commit()
-    conn.close()
+
+    c.execute("""
+        SELECT DISTINCT item_name FROM procurement_log
+        WHERE status IN (?, ?)
+    """, OPEN_PROCUREMENT_STATUSES)
+    _open_procurement_items.update(r["item_name"] for r in c.fetchall())
 
 # =========================
 # PROCUREMENT LOGIC
@@ -93,22 +141,26 @@ def calculate_replenishment_quantity(item, remaining):
     return max(baseline - remaining, int(baseline * 0.5))
 
 
-def has_open_procurement(cursor, item):
-    cursor.execute("""
-        SELECT 1 FROM procurement_log
-        WHERE item_name = ? AND status IN ('pending', 'submitted')
-        ORDER BY created_at DESC
-        LIMIT 1
-    """, (item,))
-    return cursor.fetchone() is not None
+# Items with a pending/submitted procurement_log row. Loaded by init_db and
+# kept in step by log_procurement/submit_purchase_request, so the low-stock
+# check is a set lookup instead of a query.
+_open_procurement_items = set()
+
+
+def has_open_procurement(item):
+    return item in _open_procurement_items
 
 
-def log_procurement(cursor, payload, status, response_body):
-    cursor.execute("""
-        INSERT INTO procurement_log
-        (order_id, item_name, quantity_needed, unit, status, payload, response, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+PROCUREMENT_LOG_INSERT = """
+    INSERT INTO procurement_log
+    (order_id, item_name, quantity_needed, unit, status, payload, response, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def log_procurement(cursor, payload, status, response_body, now=None):
+    # Batch callers pass now so every row shares one timestamp
+    cursor.execute(PROCUREMENT_LOG_INSERT, (
         payload.get("order_id"),
         payload.get("item_name"),
         payload.get("quantity_needed"),
@@ -116,19 +168,27 @@ def log_procurement(cursor, payload, status, response_body):
         status,
         json.dumps(payload, ensure_ascii=False),
         response_body,
-        datetime.utcnow().isoformat()
+        now or datetime.utcnow().isoformat()
     ))
 
+    # Added once the INSERT holds the write lock, so it can't interleave with
+    # submit_purchase_request's open-row check
+    if status in OPEN_PROCUREMENT_STATUSES:
+        _open_procurement_items.add(payload.get("item_name"))
 
-def trigger_purchase_request(cursor, item, remaining):
+
+def trigger_purchase_request(cursor, item, remaining, now=None):
     """
     Auto-triggered procurement when stock is low.
+    Logs the request as "pending" and returns (log_id, payload) for
+    submit_purchase_request once the caller has committed, or None if a
+    request for this item is already open.
     """
-    if has_open_procurement(cursor, item):
-        return
+    if has_open_procurement(item):
+        return None
 
     payload = {
-        "order_id": f"PR-{item}-{int(datetime.utcnow().timestamp())}",
+        "order_id": f"PR-{item}-{int(time.time())}",
         "item_name": item,
         "quantity_needed": calculate_replenishment_quantity(item, remaining),
         "unit": ITEM_UNITS.get(item),
@@ -136,12 +196,18 @@ def trigger_purchase_request(cursor, item, remaining):
         "estimated_cost": 0  # placeholder to satisfy finance required fields
     }
 
-    status = "pending"
-    response_body = None
+    log_procurement(cursor, payload, "pending", None, now)
+    return cursor.lastrowid, payload
 
+
+def submit_purchase_request(log_id, payload):
+    """
+    Runs on EXECUTOR: sends a pending auto procurement to finance and
+    records the outcome on its procurement_log row.
+    """
     try:
-        resp = requests.post(FINANCE_PURCHASE_ENDPOINT,
-                             json=payload, timeout=5)
+        resp = SESSION.post(FINANCE_PURCHASE_ENDPOINT,
+                            json=payload, timeout=5)
         response_body = resp.text
         resp.raise_for_status()
         status = "submitted"
@@ -149,7 +215,42 @@ def trigger_purchase_request(cursor, item, remaining):
         status = "failed"
         response_body = str(e)
 
-    log_procurement(cursor, payload, status, response_body)
+    # Nobody waits on this future, so log failures instead of losing them
+    conn = get_db()
+    try:
+        with conn:
+            # Write lock first: no other open row can appear mid-check
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE procurement_log SET status = ?, response = ? WHERE id = ?",
+                         (status, response_body, log_id))
+            if status == "failed":
+                # Unblock the next low-stock trigger only if no other
+                # request for the item (e.g. a manual one) is still open
+                still_open = conn.execute("""
+                    SELECT 1 FROM procurement_log
+                    WHERE item_name = ? AND status IN (?, ?) AND id != ?
+                    LIMIT 1
+                """, (payload["item_name"], *OPEN_PROCUREMENT_STATUSES, log_id)).fetchone()
+                if still_open is None:
+                    _open_procurement_items.discard(payload["item_name"])
+    except sqlite3.Error:
+        app.logger.exception("Failed to record procurement %s as %s", log_id, status)
+
+# =========================
+# STOCK CACHE
+# =========================
+
+# Encoded GET /stock body. Stock only changes in apply_consumption, which
+# clears it; "version" stops a read that raced a commit from storing a
+# stale body.
+_stock_cache = {"payload": None, "version": 0}
+_stock_lock = threading.Lock()
+
+
+def invalidate_stock_cache():
+    with _stock_lock:
+        _stock_cache["version"] += 1
+        _stock_cache["payload"] = None
 
 # =========================
 # STOCK CONSUMPTION
@@ -157,31 +258,63 @@ def trigger_purchase_request(cursor, item, remaining):
 
 
 def apply_consumption(consumption):
+    """
+    Deducts the whole batch (summed per item) with one executemany UPSERT
+    (clamped at zero in SQL; unknown items are created at 0), then reads back
+    the affected seeded items with no open request in one query to find the
+    ones that crossed the reorder threshold.
+    Runs in a single transaction that is rolled back if anything fails;
+    low-stock purchase requests are sent to finance after the commit.
+    """
     conn = get_db()
     c = conn.cursor()
+    # Only positional access below, so skip building sqlite3.Row objects
+    c.row_factory = None
 
+    # Sum repeated items first so each item is deducted by exactly one row
+    totals = Counter()
     for row in consumption:
-        item = row["item"]
-        qty = int(row["quantity"])
+        totals[row["item"]] += int(row["quantity"])
+    deductions = list(totals.items())
+    # Only seeded items without an open request can trigger a purchase
+    watched = [
+        item for item in totals
+        if item in SEED_INVENTORY and not has_open_procurement(item)
+    ]
+    purchase_requests = []
+    now = datetime.utcnow().isoformat()
 
-        c.execute("SELECT quantity FROM inventory WHERE item = ?", (item,))
-        fetched = c.fetchone()
-        if fetched is None:
-            c.execute(
-                "INSERT OR IGNORE INTO inventory (item, quantity) VALUES (?, ?)", (item, 0))
-            current = 0
-        else:
-            current = fetched["quantity"]
+    try:
+        # Take the write lock up front so all writes share a single commit
+        c.execute("BEGIN IMMEDIATE")
 
-        new_qty = max(current - qty, 0)
-        c.execute("UPDATE inventory SET quantity = ? WHERE item = ?",
-                  (new_qty, item))
+        c.executemany("""
+            INSERT INTO inventory (item, quantity) VALUES (?, 0)
+            ON CONFLICT(item) DO UPDATE SET quantity = MAX(quantity - ?, 0)
+        """, deductions)
 
-        if should_trigger_purchase(item, new_qty):
-            trigger_purchase_request(c, item, new_qty)
+        if watched:
+            placeholders = ",".join("?" * len(watched))
+            c.execute(
+                f"SELECT item, quantity FROM inventory WHERE item IN ({placeholders})", watched)
+            for item, remaining in c.fetchall():
+                if should_trigger_purchase(item, remaining):
+                    pending = trigger_purchase_request(c, item, remaining, now)
+                    if pending is not None:
+                        purchase_requests.append(pending)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # The pending procurement rows were never written
+        for _, payload in purchase_requests:
+            _open_procurement_items.discard(payload["item_name"])
+        raise
 
-    conn.commit()
-    conn.close()
+    invalidate_stock_cache()
+
+    for log_id, payload in purchase_requests:
+        EXECUTOR.submit(submit_purchase_request, log_id, payload)
 
 # =========================
 # UI
@@ -408,21 +541,27 @@ def ui():
 
 @app.route("/stock", methods=["GET"])
 def get_stock():
-    conn = get_db()
-    c = conn.cursor()
+    payload = _stock_cache["payload"]
+    if payload is None:
+        version = _stock_cache["version"]
 
-    c.execute("SELECT item, quantity FROM inventory")
-    stock = [
-        {
-            "item": r["item"],
-            "quantity": r["quantity"],
-            "unit": ITEM_UNITS.get(r["item"])
-        }
-        for r in c.fetchall()
-    ]
+        conn = get_db()
+        c = conn.cursor()
+        c.row_factory = None  # plain tuples; no sqlite3.Row per row
+
+        c.execute("SELECT item, quantity FROM inventory")
+        unit_of = ITEM_UNITS.get
+        stock = [
+            {"item": item, "quantity": quantity, "unit": unit_of(item)}
+            for item, quantity in c
+        ]
+        payload = json.dumps({"stock": stock}, separators=(",", ":")).encode("utf-8")
+
+        with _stock_lock:
+            if _stock_cache["version"] == version:
+                _stock_cache["payload"] = payload
 
-    conn.close()
-    return jsonify({"stock": stock})
+    return Response(payload, mimetype="application/json")
 
 
 @app.route("/consume", methods=["POST"])
@@ -434,17 +573,18 @@ def consume_from_kitchen():
     if not date:
         return jsonify({"error": "date is required"}), 400
 
-    resp = requests.get(KITCHEN_BATCH_ENDPOINT, params={
-                        "date": date}, timeout=5)
+    resp = SESSION.get(KITCHEN_BATCH_ENDPOINT, params={"date": date}, timeout=5)
     resp.raise_for_status()
 
-    consumption = resp.json().get("consumption", [])
+    # Kitchen always sends UTF-8 JSON, so parse the raw bytes directly
+    consumption = json.loads(resp.content).get("consumption", [])
     apply_consumption(consumption)
 
-    return jsonify({
+    payload = json.dumps({
         "message": f"Stock updated from kitchen batch for {date}",
         "items_consumed": consumption
-    })
+    }, separators=(",", ":"))
+    return Response(payload, mimetype="application/json")
 
 
 @app.route("/purchase-request", methods=["POST"])
@@ -476,15 +616,16 @@ def manual_purchase_request():
     except Exception:
         return jsonify({"error": "estimated_cost must be a number"}), 400
 
-    # Read current stock for info
+    # Read current stock for info. A plain read: an upsert here would add
+    # unknown item names to inventory and take the write lock.
     conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT quantity FROM inventory WHERE item = ?", (item,))
-    row = c.fetchone()
-    current_stock = int(row["quantity"]) if row else 0
+    c.row_factory = None
+    row = c.execute("SELECT quantity FROM inventory WHERE item = ?", (item,)).fetchone()
+    current_stock = int(row[0]) if row else 0
 
     order_id = data.get(
-        "order_id") or f"MANUAL-PR-{item}-{int(datetime.utcnow().timestamp())}"
+        "order_id") or f"MANUAL-PR-{item}-{int(time.time())}"
 
     payload = {
         "order_id": order_id,
@@ -500,8 +641,8 @@ def manual_purchase_request():
     http_status = None
 
     try:
-        resp = requests.post(FINANCE_PURCHASE_ENDPOINT,
-                             json=payload, timeout=5)
+        resp = SESSION.post(FINANCE_PURCHASE_ENDPOINT,
+                            json=payload, timeout=5)
         response_body = resp.text
         http_status = resp.status_code
         resp.raise_for_status()
@@ -513,7 +654,6 @@ def manual_purchase_request():
     # Log to procurement_log
     log_procurement(c, payload, status, response_body)
     conn.commit()
-    conn.close()
 
     # Return a helpful response to UI
     return jsonify({
@@ -534,6 +674,9 @@ def health():
 # =========================
 
 
+# On import, so gunicorn also seeds stock and loads the open-procurement set
+init_db()
+
 if __name__ == "__main__":
-    init_db()
-    app.run(port=5002, debug=True)
+    # Reloader + debugger only when asked for (FLASK_DEBUG=1)
+    app.run(port=5002, debug=os.environ.get("FLASK_DEBUG") == "1")
@@ -1,6 +1,11 @@
-from flask import Flask, jsonify, request, render_template_string
+from flask import Flask, Response, jsonify, request, render_template_string
+import json
+import os
 import sqlite3
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 from collections import defaultdict
 
@@ -13,6 +18,11 @@ DB_PATH = "indago_kitchen.db"
 ORDER_SERVICE_URL = "http://localhost:5001/orders-weekly"
 INVENTORY_STOCK_ENDPOINT = "http://localhost:5002/stock"
 
+# Shared HTTP session: keeps connections to the other services alive
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                     max_retries=Retry(total=2, backoff_factor=0.1)))
+
 # Recipes (Bill of Materials) — base units only
 RECIPES = {
     "capucino": [
@@ -25,6 +35,13 @@ RECIPES = {
     ],
 }
 
+# RECIPES as (item, qty_per_unit, unit) tuples, built once at import so the
+# per-order loop in start_production skips the per-ingredient dict lookups
+_RECIPES_FLAT = {
+    product: tuple((r["item"], r["qty_per_unit"], r["unit"]) for r in recipe)
+    for product, recipe in RECIPES.items()
+}
+
 # 🔥 Optional boot date
 BOOT_DATE = "2025-12-12"
 
@@ -33,14 +50,29 @@ BOOT_DATE = "2025-12-12"
 # =========================
 
 app = Flask(__name__)
+# Keep /start-production results in insertion order, without indentation
+app.json.sort_keys = False
+app.json.compact = True
 
 # =========================
 # DATABASE
 # =========================
 
+_local = threading.local()
+
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Opens this thread's kitchen connection with the tuning PRAGMAs on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        # The batch log is append-only; NORMAL under WAL is durable enough
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-64000")
+        _local.conn = conn
     return conn
 
 
@@ -48,6 +80,9 @@ def init_db():
     conn = get_db()
     c = conn.cursor()
 
+    # Persistent per database file: /batch reads stop blocking production writes
+    c.execute("PRAGMA journal_mode=WAL")
+
     # Append-only production log
     c.execute("""
               
@@ -60,14 +95,45 @@ def init_db():
             created_at TEXT NOT NULL
         )
     """)
+    # /batch filters on production_date and orders by item: one range seek,
+    # no sort. Supersedes the date-only index.
+    c.execute("DROP INDEX IF EXISTS idx_batch_date")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bc_date_item
+        ON batch_consumption(production_date, item)
+    """)
 
     conn.commit()
-    conn.close()
 
 # =========================
 # PRODUCTION LOGIC
 # =========================
 
+BATCH_CONSUMPTION_INSERT = """
+    INSERT INTO batch_consumption
+    (production_date, item, quantity, unit, created_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# The whole GET /batch body for one date, built by SQLite's JSON1 functions.
+# Rows are ordered in the subquery (an idx_bc_date_item range) because
+# json_group_array follows its input order.
+BATCH_CONSUMPTION_JSON = """
+    SELECT '{"date":' || json_quote(?1) || ',"consumption":' || json_group_array(json_object(
+        'production_date', production_date,
+        'item', item,
+        'quantity', quantity,
+        'unit', unit
+    )) || '}'
+    FROM (
+        SELECT production_date, item, quantity, unit
+        FROM batch_consumption
+        WHERE production_date = ?1
+        ORDER BY item
+    )
+"""
+
+
 def start_production(production_date: str):
     """
     Executes production for a specific date:
@@ -82,9 +148,10 @@ def start_production(production_date: str):
     """
 
     # -------- Fetch orders --------
-    order_resp = requests.get(ORDER_SERVICE_URL, timeout=5)
+    order_resp = SESSION.get(ORDER_SERVICE_URL, timeout=5)
     order_resp.raise_for_status()
-    orders = order_resp.json().get("orders", [])
+    # Both services always send UTF-8 JSON, so parse the raw bytes directly
+    orders = json.loads(order_resp.content).get("orders", [])
 
     # -------- Filter orders for this date --------
     daily_orders = [o for o in orders if o.get("date") == production_date]
@@ -106,14 +173,15 @@ def start_production(production_date: str):
         product = order.get("product")
         qty = int(order.get("quantity", 0))
 
-        recipe = RECIPES.get(product)
+        recipe = _RECIPES_FLAT.get(product)
         if not recipe:
             skipped_products.append(product)
             continue
 
-        for r in recipe:
-            required[r["item"]]["quantity"] += qty * r["qty_per_unit"]
-            required[r["item"]]["unit"] = r["unit"]
+        for item, qty_per_unit, unit in recipe:
+            slot = required[item]
+            slot["quantity"] += qty * qty_per_unit
+            slot["unit"] = unit
 
     required_dict = {k: v for k, v in required.items()}
 
@@ -128,10 +196,11 @@ def start_production(production_date: str):
         }
 
     # -------- Fetch inventory stock --------
-    stock_resp = requests.get(INVENTORY_STOCK_ENDPOINT, timeout=5)
+    stock_resp = SESSION.get(INVENTORY_STOCK_ENDPOINT, timeout=5)
     stock_resp.raise_for_status()
 
-    stock_lookup = {s["item"]: s["quantity"] for s in stock_resp.json().get("stock", [])}
+    stock_lookup = {s["item"]: s["quantity"]
+                    for s in json.loads(stock_resp.content).get("stock", [])}
 
     # -------- Validate stock --------
     insufficient = []
@@ -155,26 +224,19 @@ def start_production(production_date: str):
         })
 
     # -------- Append production output --------
+    now = datetime.utcnow().isoformat()
+    rows = [
+        (production_date, item, req["quantity"], req["unit"], now)
+        for item, req in required.items()
+    ]
+
     conn = get_db()
     c = conn.cursor()
-
-    inserted = 0
-    for item, req in required.items():
-        c.execute("""
-            INSERT INTO batch_consumption
-            (production_date, item, quantity, unit, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            production_date,
-            item,
-            req["quantity"],
-            req["unit"],
-            datetime.utcnow().isoformat()
-        ))
-        inserted += 1
-
-    conn.commit()
-    conn.close()
+    # Commits, or rolls back on error so the reused connection stays usable
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        c.executemany(BATCH_CONSUMPTION_INSERT, rows)
+    inserted = len(rows)
 
     return {
         "status": "success",
@@ -279,8 +341,8 @@ def start_production_route():
     try:
         result = start_production(production_date)
         return jsonify(result), 200
-    except requests.HTTPError as exc:
-        # Upstream service returned an error
+    except (requests.HTTPError, json.JSONDecodeError) as exc:
+        # Upstream service returned an error (or a body that isn't JSON)
         return jsonify({
             "status": "error",
             "message": "Upstream service error",
@@ -315,22 +377,9 @@ def get_batch():
         return jsonify({"error": "date is required (YYYY-MM-DD)"}), 400
 
     conn = get_db()
-    c = conn.cursor()
+    payload = conn.execute(BATCH_CONSUMPTION_JSON, (production_date,)).fetchone()[0]
 
-    c.execute("""
-        SELECT production_date, item, quantity, unit
-        FROM batch_consumption
-        WHERE production_date = ?
-        ORDER BY item
-    """, (production_date,))
-
-    rows = c.fetchall()
-    conn.close()
-
-    return jsonify({
-        "date": production_date,
-        "consumption": [dict(row) for row in rows]
-    })
+    return Response(payload, mimetype="application/json")
 
 
 @app.route("/", methods=["GET"])
@@ -341,9 +390,10 @@ def health():
 # STARTUP
 # =========================
 
-if __name__ == "__main__":
-    init_db()
+# Create batch_consumption on import too; gunicorn never runs __main__
+init_db()
 
+if __name__ == "__main__":
     # Optional: keep this OFF so production is triggered only via UI/button.
     # If you still want boot-time production, uncomment the next 2 lines.
     # try:
@@ -351,4 +401,5 @@ if __name__ == "__main__":
     # except Exception as e:
     #     print("Boot production failed:", e)
 
-    app.run(port=5004, debug=True)
+    # Reloader + debugger only when asked for (FLASK_DEBUG=1)
+    app.run(port=5004, debug=os.environ.get("FLASK_DEBUG") == "1")
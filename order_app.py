@@ -1,20 +1,114 @@
-from flask import Flask, request, jsonify, render_template_string, redirect, url_for
+from flask import Flask, Response, request, jsonify, redirect, url_for
+import hashlib
+import os
 import sqlite3
+import threading
 from datetime import datetime
 
 app = Flask(__name__)
+# Compact JSON for /add-orders replies, keys left in insertion order
+app.json.sort_keys = False
+app.json.compact = True
 
 INDIVIDUAL_DB = "indago_individual_orders.db"
 WEEKLY_DB = "indago_weekly_orders.db"
 
+# =========================
+# SQL STATEMENTS
+# =========================
+
+# Kept as module constants so each connection's statement cache reuses the
+# prepared statement instead of re-parsing the SQL on every request.
+# The ind. statements run on get_orders_db(), which has the individual
+# database attached.
+
+# total_price is a generated column, so it is not bound here
+SQL_INSERT_INDIVIDUAL_ORDER = """
+    INSERT INTO ind.individual_orders
+    (order_date, product, quantity, unit_price, created_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+SQL_UPSERT_WEEKLY_ORDER = """
+    INSERT INTO weekly_orders
+    (order_date, product, quantity, total_price, created_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(order_date, product) DO UPDATE SET
+        quantity = quantity + excluded.quantity,
+        total_price = total_price + excluded.total_price,
+        created_at = excluded.created_at
+"""
+
+SQL_REBUILD_WEEKLY_ORDERS = """
+    INSERT INTO weekly_orders
+    (order_date, product, quantity, total_price, created_at)
+    SELECT
+        order_date,
+        product,
+        SUM(quantity),
+        SUM(quantity * unit_price),
+        ?
+    FROM ind.individual_orders
+    GROUP BY order_date, product
+    ORDER BY order_date, product
+"""
+
+SQL_SELECT_WEEKLY_ROWS = "SELECT * FROM weekly_orders ORDER BY order_date"
+
+# The whole /orders-weekly body, built by SQLite's JSON1 functions. Rows are
+# ordered in the subquery because json_group_array follows its input order.
+SQL_SELECT_WEEKLY_ORDERS_JSON = """
+    SELECT '{"orders":' || json_group_array(json_object(
+        'date', order_date,
+        'product', product,
+        'quantity', quantity,
+        'total_price', total_price
+    )) || '}'
+    FROM (
+        SELECT order_date, product, quantity, total_price
+        FROM weekly_orders
+        ORDER BY order_date
+    )
+"""
+
 # =========================
 # DATABASE HELPERS
 # =========================
 
 
+_local = threading.local()
+
+
 def get_db(path):
-    conn = sqlite3.connect(path)
-    conn.row_factory = sqlite3.Row
+    """This thread's connection to one of the two order databases, keyed by path."""
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    conn = conns.get(path)
+    if conn is None:
+        # Plain tuple rows by default; cursors that want names ask for Row
+        conn = sqlite3.connect(path)
+        # init_dbs puts both files in WAL mode, where NORMAL is crash-safe
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-20000")
+        conns[path] = conn
+    return conn
+
+
+def get_orders_db():
+    """
+    Returns this thread's weekly connection with the individual orders
+    database attached as ind, so one transaction can write both tables.
+    """
+    conn = getattr(_local, "orders", None)
+    if conn is None:
+        conn = get_db(WEEKLY_DB)
+        conn.execute("ATTACH DATABASE ? AS ind", (INDIVIDUAL_DB,))
+        conn.execute("PRAGMA ind.synchronous=NORMAL")
+        _local.orders = conn
     return conn
 
 
@@ -22,6 +116,20 @@ def init_dbs():
     # Individual Orders
     conn = get_db(INDIVIDUAL_DB)
     c = conn.cursor()
+
+    # Persistent per database file: readers stop blocking the writer
+    c.execute("PRAGMA journal_mode=WAL")
+
+    # Older databases store total_price as a plain column written by the app.
+    # SQLite can't turn an existing column into a generated one, so such a
+    # table is rebuilt once (same ids; total_price recomputed from its inputs).
+    c.execute("PRAGMA table_xinfo(individual_orders)")
+    columns = {name: hidden for _, name, _, _, _, _, hidden in c.fetchall()}
+    legacy = bool(columns) and not columns.get("total_price")
+
+    c.execute("BEGIN IMMEDIATE")
+    if legacy:
+        c.execute("ALTER TABLE individual_orders RENAME TO individual_orders_legacy")
     c.execute("""
         CREATE TABLE IF NOT EXISTS individual_orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -29,16 +137,34 @@ def init_dbs():
             product TEXT,
             quantity INTEGER,
             unit_price INTEGER,
-            total_price INTEGER,
+            total_price INTEGER GENERATED ALWAYS AS (quantity * unit_price) STORED,
             created_at TEXT
         )
     """)
+    if legacy:
+        c.execute("""
+            INSERT INTO individual_orders
+            (id, order_date, product, quantity, unit_price, created_at)
+            SELECT id, order_date, product, quantity, unit_price, created_at
+            FROM individual_orders_legacy
+        """)
+        c.execute("DROP TABLE individual_orders_legacy")
+    # Covers aggregate_orders' GROUP BY: groups stream in index order and
+    # the sums read the index alone, with no sort or table lookups. It holds
+    # unit_price rather than total_price because SQLite won't read a
+    # generated column's value from an index.
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_ind_date_product_price
+        ON individual_orders(order_date, product, quantity, unit_price)
+    """)
     conn.commit()
-    conn.close()
 
     # Weekly Orders
     conn = get_db(WEEKLY_DB)
     c = conn.cursor()
+
+    # Persistent per database file: /orders-weekly reads stop blocking /aggregate
+    c.execute("PRAGMA journal_mode=WAL")
     c.execute("""
         CREATE TABLE IF NOT EXISTS weekly_orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -50,7 +176,37 @@ def init_dbs():
         )
     """)
     conn.commit()
-    conn.close()
+
+    # /add-order keeps weekly_orders current with an UPSERT on (order_date,
+    # product). Before the first run with that index, rebuild the table so
+    # it matches individual_orders and holds one row per pair.
+    c.execute("""
+        SELECT 1 FROM sqlite_master
+        WHERE type = 'index' AND name = 'idx_weekly_date_product'
+    """)
+    if c.fetchone() is None:
+        aggregate_orders()
+    c.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_weekly_date_product
+        ON weekly_orders(order_date, product)
+    """)
+    conn.commit()
+
+# =========================
+# WEEKLY ORDERS CACHE
+# =========================
+
+# (body, etag) for GET /orders-weekly. weekly_orders only changes in
+# /add-order, /add-orders and aggregate_orders, which clear it; "version"
+# stops a read that raced a commit from storing a stale body.
+_weekly_cache = {"entry": None, "version": 0}
+_weekly_lock = threading.Lock()
+
+
+def invalidate_weekly_cache():
+    with _weekly_lock:
+        _weekly_cache["version"] += 1
+        _weekly_cache["entry"] = None
 
 # =========================
 # AGGREGATION LOGIC
@@ -58,41 +214,21 @@ def init_dbs():
 
 
 def aggregate_orders():
-    src = get_db(INDIVIDUAL_DB)
-    dst = get_db(WEEKLY_DB)
-
-    sc = src.cursor()
-    dc = dst.cursor()
-
-    dc.execute("DELETE FROM weekly_orders")
-
-    sc.execute("""
-        SELECT
-            order_date,
-            product,
-            SUM(quantity) AS qty,
-            SUM(total_price) AS total
-        FROM individual_orders
-        GROUP BY order_date, product
-        ORDER BY order_date
-    """)
+    """
+    Rebuilds weekly_orders from individual_orders with one INSERT ... SELECT.
+    /add-order already keeps the table current; this is the full recompute.
+    The individual orders database is attached to the weekly one, so the
+    grouped rows never pass through Python.
+    """
+    conn = get_orders_db()
+    c = conn.cursor()
 
-    for row in sc.fetchall():
-        dc.execute("""
-            INSERT INTO weekly_orders
-            (order_date, product, quantity, total_price, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            row["order_date"],
-            row["product"],
-            row["qty"],
-            row["total"],
-            datetime.utcnow().isoformat()
-        ))
-
-    dst.commit()
-    src.close()
-    dst.close()
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DELETE FROM weekly_orders")
+        c.execute(SQL_REBUILD_WEEKLY_ORDERS, (datetime.utcnow().isoformat(),))
+
+    invalidate_weekly_cache()
 
 # =========================
 # UI (SIMPLE HTML)
@@ -150,6 +286,10 @@ HTML = """
 </html>
 """
 
+# Compiled once in Flask's own environment (same autoescaping);
+# render_template_string re-parses HTML on every request
+HOME_TEMPLATE = app.jinja_env.from_string(HTML)
+
 # =========================
 # ROUTES
 # =========================
@@ -159,11 +299,11 @@ HTML = """
 def home():
     conn = get_db(WEEKLY_DB)
     c = conn.cursor()
-    c.execute("SELECT * FROM weekly_orders ORDER BY order_date")
+    c.row_factory = sqlite3.Row  # the template reads columns by name
+    c.execute(SQL_SELECT_WEEKLY_ROWS)
     weekly = c.fetchall()
-    conn.close()
 
-    return render_template_string(HTML, weekly=weekly)
+    return HOME_TEMPLATE.render(weekly=weekly)
 
 
 @app.route("/add-order", methods=["POST"])
@@ -173,28 +313,85 @@ def add_order():
     qty = int(request.form["quantity"])
     price = int(request.form["unit_price"])
 
-    conn = get_db(INDIVIDUAL_DB)
+    now = datetime.utcnow().isoformat()
+
+    # Record the order and fold it into its weekly row in one transaction
+    conn = get_orders_db()
     c = conn.cursor()
 
-    c.execute("""
-        INSERT INTO individual_orders
-        (order_date, product, quantity, unit_price, total_price, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (
-        date,
-        product,
-        qty,
-        price,
-        qty * price,
-        datetime.utcnow().isoformat()
-    ))
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(SQL_INSERT_INDIVIDUAL_ORDER,
+                  (date, product, qty, price, now))
+        c.execute(SQL_UPSERT_WEEKLY_ORDER,
+                  (date, product, qty, qty * price, now))
 
-    conn.commit()
-    conn.close()
+    invalidate_weekly_cache()
 
     return redirect(url_for("home"))
 
 
+@app.route("/add-orders", methods=["POST"])
+def add_orders():
+    """
+    Bulk version of /add-order: records every order and folds it into
+    weekly_orders in one transaction.
+    Body:
+      {
+        "orders": [
+          {"order_date": "2025-12-12", "product": "Latte", "quantity": 2, "unit_price": 30000},
+          ...
+        ]
+      }
+    """
+    data = request.get_json(silent=True)
+    orders = data.get("orders") if isinstance(data, dict) else None
+    if not isinstance(orders, list) or not orders:
+        return jsonify({"error": "orders must be a non-empty list"}), 400
+
+    required = ["order_date", "product", "quantity", "unit_price"]
+    now = datetime.utcnow().isoformat()
+    individual_rows = []
+    weekly_rows = []
+
+    for i, o in enumerate(orders):
+        if not isinstance(o, dict) or not all(k in o for k in required):
+            return jsonify({"error": f"orders[{i}] missing required fields: {required}"}), 400
+        # Same guarantee as the form path: NULL or non-text keys would slip
+        # past the weekly ON CONFLICT(order_date, product) and bind errors
+        if not all(isinstance(o[k], str) and o[k] for k in ("order_date", "product")):
+            return jsonify({"error": f"orders[{i}] order_date and product must be non-empty strings"}), 400
+        # Whole numbers only (digit strings too, as the form sends); int()
+        # alone would truncate 2.9 and accept true
+        numbers = []
+        for k in ("quantity", "unit_price"):
+            v = o[k]
+            if isinstance(v, str) and v.isascii() and v.isdigit():
+                v = int(v)
+            if not isinstance(v, int) or isinstance(v, bool):
+                return jsonify({"error": f"orders[{i}] quantity and unit_price must be integers"}), 400
+            numbers.append(v)
+        qty, price = numbers
+
+        individual_rows.append((o["order_date"], o["product"], qty, price, now))
+        weekly_rows.append((o["order_date"], o["product"], qty, qty * price, now))
+
+    conn = get_orders_db()
+    c = conn.cursor()
+
+    with conn:
+        c.execute("BEGIN IMMEDIATE")
+        c.executemany(SQL_INSERT_INDIVIDUAL_ORDER, individual_rows)
+        c.executemany(SQL_UPSERT_WEEKLY_ORDER, weekly_rows)
+
+    invalidate_weekly_cache()
+
+    return jsonify({
+        "message": "Orders saved",
+        "inserted_rows": len(individual_rows)
+    }), 201
+
+
 @app.route("/aggregate", methods=["POST"])
 def aggregate():
     aggregate_orders()
@@ -203,34 +400,36 @@ def aggregate():
 
 @app.route("/orders-weekly", methods=["GET"])
 def orders_weekly_api():
-    conn = get_db(WEEKLY_DB)
-    c = conn.cursor()
-
-    c.execute("""
-        SELECT order_date, product, quantity, total_price
-        FROM weekly_orders
-        ORDER BY order_date
-    """)
+    """
+    Returns weekly_orders as {"orders": [...]}. SQLite encodes the whole
+    document, so no row is converted or serialized in Python. The body is
+    cached until the next write, and a matching If-None-Match gets a 304.
+    """
+    entry = _weekly_cache["entry"]
+    if entry is None:
+        version = _weekly_cache["version"]
 
-    orders = [
-        {
-            "date": r["order_date"],
-            "product": r["product"],
-            "quantity": r["quantity"],
-            "total_price": r["total_price"]
-        }
-        for r in c.fetchall()
-    ]
+        conn = get_db(WEEKLY_DB)
+        payload = conn.execute(SQL_SELECT_WEEKLY_ORDERS_JSON).fetchone()[0].encode("utf-8")
+        entry = (payload, hashlib.sha1(payload).hexdigest())
 
-    conn.close()
+        with _weekly_lock:
+            if _weekly_cache["version"] == version:
+                _weekly_cache["entry"] = entry
 
-    return jsonify({"orders": orders})
+    payload, etag = entry
+    resp = Response(payload, mimetype="application/json")
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
 
 
 # =========================
 # STARTUP
 # =========================
 
+# Schema and one-time migrations run on import, so gunicorn workers get them
+init_dbs()
+
 if __name__ == "__main__":
-    init_dbs()
-    app.run(port=5001, debug=True)
+    # Reloader + debugger only when asked for (FLASK_DEBUG=1)
+    app.run(port=5001, debug=os.environ.get("FLASK_DEBUG") == "1")